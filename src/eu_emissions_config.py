@@ -19,6 +19,15 @@ COUNTRY_EXCLUDES = ["EU27"]
 
 EMISSIONS_COLUMN = "emissions_-_eea_[kt]"
 
+CATEGORICAL_COLUMNS = [
+    "country_code",
+    "country_name",
+    "gas_scope",
+    "crf_code",
+    "sector_code",
+    "sector_name",
+]
+
 OVERALL_SECTOR_CODES = ["1", "2", "3", "4", "5", "6"]
 ENERGY_SECTOR_CODES = [
     "1.A.1",
@@ -1,11 +1,30 @@
 """Function to facilitate the EU emissions analysis."""
 
+import functools
+
+import matplotlib
+
+# Plots are only saved to file, so use the non-interactive Agg backend.
+matplotlib.use("Agg")
+
 import seaborn as sns
-import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+import numpy as np
 import pandas as pd
 
 
+@functools.lru_cache(maxsize=32)
+def _legend_handles(colors):
+    """Get legend handles for a sequence of colors, reusing them between
+    plots with the same colors."""
+
+    return tuple(
+        mpatches.Rectangle((0, 0), 0.1, 0.1, color=color) for color in colors
+    )
+
+
 def plot_basic_barplot(
     emissions_df,
     emissions_col,
@@ -19,7 +38,8 @@ def plot_basic_barplot(
 ):
     """Function to create a basic barplot."""
 
-    fig, ax = plt.subplots()
+    fig = Figure()
+    ax = fig.subplots()
 
     # Create barplot.
     sns.barplot(
@@ -30,6 +50,7 @@ def plot_basic_barplot(
         hue=hue_col,
         hue_order=hue_order,
         palette=palette,
+        ax=ax,
     )
 
     # Set labels and titles.
@@ -45,10 +66,15 @@ def plot_basic_barplot(
     xticklabels = ax.get_xticklabels()
     ax.set_xticklabels(xticklabels, rotation=75)
 
-    # Save figure.
-    fig.savefig(save_dir + save_name, bbox_inches="tight")
-
-    plt.close()
+    # Save figure, using fast, light PNG compression as the flat colour bar
+    # charts compress well regardless.
+    fig.savefig(
+        save_dir + save_name,
+        bbox_inches="tight",
+        dpi=300,
+        pil_kwargs={"compress_level": 1, "optimize": False},
+        metadata={"Software": None},
+    )
 
     return fig, ax
 
@@ -68,96 +94,78 @@ def plot_stacked_barplot(
 ):
     """Create stacked bar plot, split by group col and stacked by hue_col."""
 
-    fig, ax = plt.subplots()
+    fig = Figure()
+    ax = fig.subplots()
+
+    # Sum emissions, positive emissions and negative emissions for each group
+    # in a single pass. Groups are ordered by their absolute emissions, even
+    # when plotting shares.
+    sort_col = emissions_col.removesuffix("_share")
+    group_sums = (
+        emissions_df.assign(
+            emissions_above=emissions_df[emissions_col].clip(lower=0),
+            emissions_below=emissions_df[emissions_col].clip(upper=0),
+        )
+        .groupby(group_col, observed=True)[
+            [sort_col, "emissions_above", "emissions_below"]
+        ]
+        .sum()
+    )
 
     # Determine order of groups along x-axis.
-    if statistic != "share":
-        group_sums_sorted = (
-            emissions_df.groupby(group_col)[emissions_col]
-            .sum()
-            .sort_values(ascending=False)
-        )
-    else:
-        group_sums_sorted = (
-            emissions_df.groupby(group_col)[
-                emissions_col.removesuffix("_share")
-            ]
-            .sum()
-            .sort_values(ascending=False)
-        )
+    group_sums_sorted = group_sums[sort_col].sort_values(ascending=False)
     group_order = group_sums_sorted.index.to_list()
 
-    # Determine maximum positive and negative extent of bars.
-    group_pos_max = (
-        emissions_df.loc[emissions_df[emissions_col].gt(0)]
-        .groupby(group_col)[emissions_col]
-        .sum()
-        .max()
+    # Determine maximum positive and negative extent of bars, no negative
+    # extent when there are no negative emissions.
+    group_pos_max = group_sums["emissions_above"].max()
+    group_neg_max = group_sums["emissions_below"].replace(0, np.nan).min()
+
+    # Arrange emissions into a group by hue grid, in plotting order.
+    emissions_grid = (
+        emissions_df.pivot_table(
+            index=group_col,
+            columns=hue_col,
+            values=emissions_col,
+            aggfunc="sum",
+            observed=True,
+        )
+        .reindex(index=group_order, columns=hue_order)
+        .fillna(0)
+        .to_numpy()
     )
 
-    group_neg_max = (
-        emissions_df.loc[emissions_df[emissions_col].lt(0)]
-        .groupby(group_col)[emissions_col]
-        .sum()
-        .min()
-    )
+    # Split into emissions stacked above zero and absorption stacked below.
+    emissions_above = np.where(emissions_grid > 0, emissions_grid, 0)
+    emissions_below = np.where(emissions_grid < 0, emissions_grid, 0)
+    bottoms_above = np.cumsum(emissions_above, axis=1) - emissions_above
+    bottoms_below = np.cumsum(emissions_below, axis=1)
+
+    # Create the bars for each hue level across all groups at once.
+    group_locs = np.arange(len(group_order)) - 0.5
+    for idx, hue in enumerate(hue_order):
+        ax.bar(
+            x=group_locs,
+            height=emissions_above[:, idx],
+            width=0.8,
+            bottom=bottoms_above[:, idx],
+            color=palette[hue],
+            zorder=1,
+        )
+        ax.bar(
+            x=group_locs,
+            height=-1 * emissions_below[:, idx],
+            width=0.8,
+            bottom=bottoms_below[:, idx],
+            color=palette[hue],
+            zorder=1,
+        )
 
-    # Loop over groups creating stacked bars for each.
-    group_loc = -0.5
-    group_locs = []
-    net_patches_to_add = []
-    for idx, group in enumerate(group_order):
-        # Select emissions for group.
-        group_df = emissions_df.loc[emissions_df[group_col].eq(group), :]
-
-        # Loop over each hue for group stacking up the emisssions.
-        bottom_above = 0
-        bottom_below = 0
-        for hue in hue_order:
-            # Select emissions from group for this hue.
-            emissions = group_df.loc[
-                group_df[hue_col].eq(hue), emissions_col
-            ].squeeze()
-
-            # If no emissions for this hue group pair then continue,
-            if isinstance(emissions, pd.Series):
-                continue
-
-            # If negative emissions then stack below zero, otherwise stack
-            # above.
-            if emissions < 0:
-                tmp_bottom = bottom_below + emissions
-                height = -1 * emissions
-            else:
-                tmp_bottom = bottom_above
-                height = emissions
-
-            # Create bar for hue level, increment starting point for next bar.
-            if pd.notna(emissions):
-                plt.bar(
-                    x=group_loc,
-                    height=height,
-                    width=0.8,
-                    bottom=tmp_bottom,
-                    color=palette[hue],
-                    zorder=1,
-                )
-                if emissions < 0:
-                    bottom_below = bottom_below + emissions
-                else:
-                    bottom_above = bottom_above + emissions
-
-            else:
-                continue
-
-        # When any of the emissions are negative for group add a record to
-        # produce a net emissions rectangle patch later.
-        if bottom_below != 0:
-            net_patches_to_add.append(group)
-
-        # Record location for group, and increment position of next group.
-        group_locs.append(group_loc)
-        group_loc = group_loc + 1
+    # When any of the emissions are negative for group record its location
+    # and net emissions to produce a net emissions rectangle patch later.
+    has_negative = emissions_below.any(axis=1)
+    net_patch_locs = group_locs[has_negative]
+    net_patch_emissions = group_sums_sorted.to_numpy()[has_negative]
 
     # Set xticks, rotate labels.
     ax.set_xticks(ticks=group_locs, labels=group_order)
@@ -165,10 +173,7 @@ def plot_stacked_barplot(
     ax.set_xticklabels(xticklabels, rotation=75)
 
     # Create legend handles.
-    handles = [
-        mpatches.Rectangle((0, 0), 0.1, 0.1, color=palette[x])
-        for x in hue_order
-    ]
+    handles = list(_legend_handles(tuple(palette[x] for x in hue_order)))
 
     # Determine positioning of legend, based on whether absolute or share of
     # emissions is being plotted.
@@ -191,16 +196,16 @@ def plot_stacked_barplot(
         ncol=ncols,
     )
 
-    # Draw to establish legend extents.
-    fig.canvas.draw()
+    # Lay out figure, without rasterising, to establish legend extents.
+    fig.draw_without_rendering()
 
     # Get legend bbox, convert to axes coordinates.
-    bbox = leg1.get_frame().get_bbox()
+    bbox = leg1.get_window_extent()
     transformed = bbox.transformed(ax.transAxes.inverted())
-    yloc= transformed.bounds[1]
+    yloc = transformed.y0
 
     # Add legend.
-    plt.gcf().add_artist(leg1)
+    fig.add_artist(leg1)
 
     # Set labels and title.
     ax.set_xlabel(group_col.replace("_", " ").replace(" name", "").title())
@@ -221,22 +226,32 @@ def plot_stacked_barplot(
         )
 
     # If there are any net emissions patches to add...
-    if len(net_patches_to_add) > 0:
-        # Add them one by one.
-        for net_patch in net_patches_to_add:
-            net_emissions = mpatches.Rectangle(
-                xy=(
-                    -0.5 + group_order.index(net_patch) - 0.1,
-                    group_sums_sorted.loc[net_patch]
-                    - 0.005 * (ax.get_ylim()[1] - ax.get_ylim()[0]),
-                ),
+    if has_negative.any():
+        # Add them all as a single collection.
+        y_range = ax.get_ylim()[1] - ax.get_ylim()[0]
+        net_rectangles = [
+            mpatches.Rectangle(
+                xy=(net_loc - 0.1, net_total - 0.005 * y_range),
                 width=0.2,
-                height=0.01 * (ax.get_ylim()[1] - ax.get_ylim()[0]),
+                height=0.01 * y_range,
+            )
+            for net_loc, net_total in zip(
+                net_patch_locs, net_patch_emissions
+            )
+        ]
+        ax.add_collection(
+            PatchCollection(
+                net_rectangles,
                 edgecolor="black",
                 facecolor="none",
                 zorder=4,
             )
-            ax.add_patch(net_emissions)
+        )
+
+        # Legend handle matching the net emissions patches.
+        net_emissions = mpatches.Rectangle(
+            (0, 0), 0.1, 0.1, edgecolor="black", facecolor="none"
+        )
 
         leg2 = ax.legend(
             handles=[net_emissions],
@@ -244,11 +259,15 @@ def plot_stacked_barplot(
             loc="upper right",
             bbox_to_anchor=(1.0, yloc - 0.01)
         )
-        plt.gca().add_artist(leg2)
-
-    # Save plot.
-    fig.savefig(save_dir + save_name, bbox_inches="tight")
-
-    plt.close()
+        ax.add_artist(leg2)
+
+    # Save plot, using fast, light PNG compression.
+    fig.savefig(
+        save_dir + save_name,
+        bbox_inches="tight",
+        dpi=300,
+        pil_kwargs={"compress_level": 1, "optimize": False},
+        metadata={"Software": None},
+    )
 
     return fig, ax
@@ -1,5 +1,14 @@
 """Main script for EU emissions analysis."""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import os
+import warnings
+
+import matplotlib
+
+# Plots are only saved to file, so use the non-interactive Agg backend.
+matplotlib.use("Agg")
 
 from matplotlib import rcParams
 import pandas as pd
@@ -13,7 +22,7 @@ import src.eu_emissions_functions as euf
 
 rcParams["font.family"] = "Serif"
 rcParams["figure.figsize"] = (16, 9)
-rcParams["figure.dpi"] = 300
+rcParams["figure.dpi"] = 100
 rcParams["axes.titlesize"] = 24
 rcParams["axes.labelsize"] = 18
 rcParams["font.size"] = 16
@@ -21,6 +30,55 @@ rcParams["xtick.labelsize"] = 16
 rcParams["ytick.labelsize"] = 14
 rcParams["legend.fontsize"] = 12
 rcParams["legend.title_fontsize"] = 16
+rcParams["path.simplify"] = True
+rcParams["agg.path.chunksize"] = 10000
+
+# Boolean row masks shared when selecting the data for each plot.
+Masks = namedtuple("Masks", "not_excluded gas_total crf_total")
+
+# Cache population lookups so each country is only resolved once per run.
+_get_population_a2 = functools.lru_cache(maxsize=None)(pyp.get_population_a2)
+
+
+def load_emissions_data(excel_path, sheet_name, emissions_col):
+    """Load and clean the emissions data. The raw excel sheet is cached as
+    parquet, and the cache is used when it is newer than the excel file."""
+
+    parquet_path = f"{excel_path}.{sheet_name}.parquet"
+
+    # Use cached sheet if it is up to date with the excel file, otherwise
+    # read in emissions data and try to cache it for subsequent runs.
+    if os.path.exists(parquet_path) and os.path.getmtime(
+        parquet_path
+    ) >= os.path.getmtime(excel_path):
+        emissions_df = pd.read_parquet(parquet_path)
+    else:
+        emissions_df = pd.read_excel(
+            excel_path, sheet_name=sheet_name, engine="calamine"
+        )
+        try:
+            emissions_df.to_parquet(parquet_path)
+        except (OSError, TypeError, ValueError, NotImplementedError) as err:
+            warnings.warn(f"Could not cache emissions data: {err}")
+            # Do not leave a partially written cache behind.
+            if os.path.exists(parquet_path):
+                os.remove(parquet_path)
+
+    # Convert column names to snake case.
+    emissions_df = emissions_df.rename(
+        columns={
+            col: col.lower().replace(" ", "_").replace("/", "_")
+            for col in emissions_df.columns
+        }
+    )
+
+    # Convert kilo tonnes to mega tonnes.
+    emissions_df[emissions_col] = (
+        pd.to_numeric(emissions_df[emissions_col], errors="coerce")
+        / 1000
+    )
+
+    return emissions_df
 
 
 def create_emissions_per_capita(
@@ -38,43 +96,42 @@ def create_emissions_per_capita(
     )
 
     # Get all unique country codes.
-    countries = list(
-        emissions_df.loc[
-            ~emissions_df["country_code"].isin(cfg.COUNTRY_EXCLUDES),
-            "country_code",
-        ].unique()
-    )
+    countries = emissions_df.loc[
+        ~emissions_df["country_code"].isin(cfg.COUNTRY_EXCLUDES),
+        "country_code",
+    ].unique()
 
     # Use pypopulation to get populations for each alpha-2 code.
-    country_population_dict = {}
-    for country in countries:
-        country_population_dict[country] = pyp.get_population_a2(country)
+    country_populations = pd.Series(
+        {country: _get_population_a2(country) for country in countries},
+        dtype="float64",
+    )
 
     # Create population column.
     emissions_df["population"] = emissions_df["country_code"].map(
-        country_population_dict
+        country_populations
     )
 
-    # Create emissions per capita column, measured in tonnes CO2.
-    emissions_df["emissions_per_capita"] = np.where(
-        emissions_df["population"].notnull(),
-        1e6 * emissions_df[emissions_col] / emissions_df["population"],
-        np.nan,
+    # Create emissions per capita column, measured in tonnes CO2, only
+    # dividing where a population is available.
+    emissions_per_capita = np.full(len(emissions_df), np.nan)
+    np.divide(
+        emissions_df[emissions_col].to_numpy(dtype="float64"),
+        emissions_df["population"].to_numpy(dtype="float64"),
+        out=emissions_per_capita,
+        where=emissions_df["population"].notnull().to_numpy(),
     )
+    emissions_per_capita *= 1e6
+    emissions_df["emissions_per_capita"] = emissions_per_capita
 
     return emissions_df
 
 
-def create_overall_barplot(emissions_df, emissions_col, save_dir):
+def create_overall_barplot(
+    country_overall_emissions, emissions_col, save_dir
+):
     """Function to create an overall barplot showing the emissions by
-    country."""
-
-    # Select all relevant country summaries.
-    country_overall_emissions = emissions_df.loc[
-        emissions_df["gas_scope"].eq(cfg.GAS_SCOPE_SUMMARY)
-        & emissions_df["crf_code"].eq(cfg.CRF_CODE_SUMMARY)
-        & ~emissions_df["country_code"].isin(cfg.COUNTRY_EXCLUDES)
-    ]
+    country, from the overall emissions summary for each country."""
 
     # Determine order for plot from most to least.
     country_emissions_order = country_overall_emissions.sort_values(
@@ -99,16 +156,9 @@ def create_overall_barplot(emissions_df, emissions_col, save_dir):
     return country_emissions_order
 
 
-def create_emissions_by_gas(emissions_df, emissions_col, statistic, save_dir):
+def create_emissions_by_gas(gas_emissions, emissions_col, statistic, save_dir):
     """Create a stacked barplot of emissions split by country and stacked by
-    gas."""
-
-    # Select the emissions for each gas for each country.
-    gas_emissions = emissions_df.loc[
-        emissions_df["crf_code"].eq(cfg.CRF_CODE_SUMMARY)
-        & ~emissions_df["country_code"].isin(cfg.COUNTRY_EXCLUDES)
-        & ~emissions_df["gas_scope"].eq(cfg.GAS_SCOPE_SUMMARY)
-    ].reset_index(drop=True)
+    gas, from the total emissions of each gas for each country."""
 
     # Set up labels, titles, save names.
     if emissions_col == "emissions_per_capita":
@@ -127,34 +177,16 @@ def create_emissions_by_gas(emissions_df, emissions_col, statistic, save_dir):
         # For percentage shares only consider emissions, not any absorption.
         gas_emissions = gas_emissions.loc[
             gas_emissions[emissions_col].gt(0)
-        ].reset_index(drop=True)
+        ].copy()
 
         # Determine the total emisssions for each country.
-        country_totals = gas_emissions.groupby("country_code")[
-            emissions_col
-        ].sum()
-
-        # Reshape and rename to facilitate concat.
-        emissions_country_totals = (
-            country_totals.loc[gas_emissions["country_code"].to_list()]
-            .rename("country_total_emissions")
-            .reset_index()
-        )
-
-        # Concatenate country emissions total
-        gas_emissions = pd.concat(
-            [
-                gas_emissions,
-                emissions_country_totals["country_total_emissions"],
-            ],
-            axis=1,
-        )
+        country_totals = gas_emissions.groupby(
+            "country_code", observed=True, sort=False
+        )[emissions_col].transform("sum")
 
         # Create emissions share columns.
         gas_emissions[emissions_col + "_share"] = (
-            100
-            * gas_emissions[emissions_col]
-            / gas_emissions["country_total_emissions"]
+            100 * gas_emissions[emissions_col] / country_totals
         )
 
         # Adjust columns, labels, titles, save names.
@@ -169,7 +201,7 @@ def create_emissions_by_gas(emissions_df, emissions_col, statistic, save_dir):
     title = "\n".join(wrap(title, 60, break_long_words=False))
     # Determine order for plot stacks.
     gas_emissions_order = (
-        gas_emissions.groupby("gas_scope")[emissions_col]
+        gas_emissions.groupby("gas_scope", observed=True)[emissions_col]
         .sum()
         .sort_values(ascending=False)
         .index.to_list()
@@ -197,29 +229,18 @@ def create_emissions_by_gas(emissions_df, emissions_col, statistic, save_dir):
 
 
 def create_emissions_by_sector(
-    emissions_df,
+    sector_overall_emissions,
     emissions_col,
     sector,
-    sector_codes,
     palette,
     statistic,
     save_dir,
 ):
-    """Create stacked barplot of countries emissions stacked by sectors."""
+    """Create stacked barplot of countries emissions stacked by sectors, from
+    the sub-sector emissions for the sector."""
 
-    # Select sub-sector emissions for sector.
-    sector_overall_emissions = emissions_df.loc[
-        ~emissions_df["country_code"].isin(cfg.COUNTRY_EXCLUDES)
-        & emissions_df["gas_scope"].eq(cfg.GAS_SCOPE_SUMMARY)
-        & emissions_df["sector_code"].isin(sector_codes)
-    ]
-
-    # Clean up sector names.
-    sector_overall_emissions["sector_name"] = (
-        sector_overall_emissions["sector_name"]
-        .str.split("-")
-        .apply(lambda x: "-".join(x[1:]))
-    )
+    # Work on a copy as columns are added below.
+    sector_overall_emissions = sector_overall_emissions.copy()
 
     # Setup labels, titles, save name.
     if emissions_col == "emissions_per_capita":
@@ -237,9 +258,11 @@ def create_emissions_by_sector(
     # Determine ordering of each sector within stacks.
     sector_overall_emissions["abs_emissions"] = sector_overall_emissions[
         emissions_col
-    ].apply(np.abs)
+    ].abs()
     sector_emissions_order = (
-        sector_overall_emissions.groupby("sector_name")["abs_emissions"]
+        sector_overall_emissions.groupby("sector_name", observed=True)[
+            "abs_emissions"
+        ]
         .sum()
         .sort_values(ascending=False)
         .index.to_list()
@@ -247,7 +270,9 @@ def create_emissions_by_sector(
 
     # Determine palette colors for each sub-sector.
     palette_mapping = (
-        sector_overall_emissions.groupby("sector_code")["sector_name"]
+        sector_overall_emissions.groupby("sector_code", observed=True)[
+            "sector_name"
+        ]
         .first()
         .to_dict()
     )
@@ -258,34 +283,14 @@ def create_emissions_by_sector(
         # Only consider emissions not absorption.
         sector_overall_emissions = sector_overall_emissions.loc[
             sector_overall_emissions[emissions_col].gt(0)
-        ].reset_index(drop=True)
-
-        # Calculate total emissions for each country.
-        country_totals = sector_overall_emissions.groupby("country_code")[
-            emissions_col
-        ].sum()
-
-        # Reshape and rename to facilitate concat.
-        emissions_country_totals = (
-            country_totals.loc[
-                sector_overall_emissions["country_code"].to_list()
-            ]
-            .rename("country_total_emissions")
-            .reset_index()
-        )
+        ].copy()
 
-        # Concatenate and calculate emissions share.
-        sector_overall_emissions = pd.concat(
-            [
-                sector_overall_emissions,
-                emissions_country_totals["country_total_emissions"],
-            ],
-            axis=1,
-        )
+        # Calculate total emissions for each country and emissions share.
+        country_totals = sector_overall_emissions.groupby(
+            "country_code", observed=True, sort=False
+        )[emissions_col].transform("sum")
         sector_overall_emissions[emissions_col + "_share"] = (
-            100
-            * sector_overall_emissions[emissions_col]
-            / sector_overall_emissions["country_total_emissions"]
+            100 * sector_overall_emissions[emissions_col] / country_totals
         )
 
         # Update emissions column, label, title, save name.
@@ -315,25 +320,22 @@ def create_emissions_by_sector(
     )
 
 
+def _run_plot_task(plot_task):
+    """Run a (plot function, keyword arguments) pair in a worker process."""
+
+    plot_function, kwargs = plot_task
+
+    return plot_function(**kwargs)
+
+
 def main():
     """Main emissions analysis function."""
 
     # Read in emissions data.
-    emissions_df = pd.read_excel(
-        cfg.DATA_PATH + cfg.FILE_NAME, sheet_name=cfg.SHEET_NAME
-    )
-
-    # Convert column names to snake case.
-    emissions_df.columns = (
-        emissions_df.columns.str.lower()
-        .str.replace(" ", "_")
-        .str.replace("/", "_")
-    )
-
-    # Convert kilo tonnes to mega tonnes.
-    emissions_df[cfg.EMISSIONS_COLUMN] = (
-        pd.to_numeric(emissions_df[cfg.EMISSIONS_COLUMN], errors="coerce")
-        / 1000
+    emissions_df = load_emissions_data(
+        excel_path=cfg.DATA_PATH + cfg.FILE_NAME,
+        sheet_name=cfg.SHEET_NAME,
+        emissions_col=cfg.EMISSIONS_COLUMN,
     )
 
     # Create emissions per capita using country population data.
@@ -343,6 +345,59 @@ def main():
         country_code_mappings=cfg.COUNTRY_CODE_MAPPINGS,
     )
 
+    # Clean up sector names.
+    emissions_df["sector_name"] = (
+        emissions_df["sector_name"]
+        .str.split("-", n=1)
+        .str[1]
+        .fillna(emissions_df["sector_name"])
+    )
+
+    # Store low cardinality label columns as categoricals.
+    for col in cfg.CATEGORICAL_COLUMNS:
+        emissions_df[col] = emissions_df[col].astype("category")
+
+    # Sort so that rows for each country are contiguous.
+    emissions_df = emissions_df.sort_values(
+        ["country_code", "sector_code", "gas_scope"], kind="mergesort"
+    ).reset_index(drop=True)
+
+    # Determine the row masks used by each plot once, up front.
+    masks = Masks(
+        not_excluded=(
+            ~emissions_df["country_code"].isin(cfg.COUNTRY_EXCLUDES)
+        ).to_numpy(),
+        gas_total=emissions_df["gas_scope"]
+        .eq(cfg.GAS_SCOPE_SUMMARY)
+        .to_numpy(),
+        crf_total=emissions_df["crf_code"].eq(cfg.CRF_CODE_SUMMARY).to_numpy(),
+    )
+
+    # Overall emissions summary for each country.
+    country_overall_emissions = emissions_df.iloc[
+        np.flatnonzero(masks.not_excluded & masks.gas_total & masks.crf_total)
+    ]
+
+    # Total emissions of each gas for each country.
+    gas_emissions = emissions_df.iloc[
+        np.flatnonzero(masks.not_excluded & masks.crf_total & ~masks.gas_total)
+    ]
+
+    # Sub-sector emissions for each sector.
+    sector_emissions = {}
+    for sector, sector_codes_palettes in cfg.SECTOR_DICTIONARIES.items():
+        sector_mask = (
+            emissions_df["sector_code"]
+            .isin(list(sector_codes_palettes.keys()))
+            .to_numpy()
+        )
+        sector_emissions[sector] = emissions_df.iloc[
+            np.flatnonzero(masks.not_excluded & masks.gas_total & sector_mask)
+        ]
+
+    # Collect plots to create, as (plot function, keyword arguments) pairs.
+    plot_tasks = []
+
     # For total emissions and emissions per capita...
     for emissions_col in [cfg.EMISSIONS_COLUMN, "emissions_per_capita"]:
         if emissions_col == "emissions_per_capita":
@@ -353,10 +408,15 @@ def main():
         os.makedirs(save_dir, exist_ok=True)
 
         # Create a simple emissions by country baplot.
-        create_overall_barplot(
-            emissions_df=emissions_df,
-            emissions_col=emissions_col,
-            save_dir=save_dir,
+        plot_tasks.append(
+            (
+                create_overall_barplot,
+                dict(
+                    country_overall_emissions=country_overall_emissions,
+                    emissions_col=emissions_col,
+                    save_dir=save_dir,
+                ),
+            )
         )
 
         # For either absolute emissions or share of emissions...
@@ -368,11 +428,16 @@ def main():
                 continue
 
             # Create stacked barplot of emissions by country split by gas.
-            create_emissions_by_gas(
-                emissions_df=emissions_df,
-                emissions_col=emissions_col,
-                statistic=statistic,
-                save_dir=save_dir,
+            plot_tasks.append(
+                (
+                    create_emissions_by_gas,
+                    dict(
+                        gas_emissions=gas_emissions,
+                        emissions_col=emissions_col,
+                        statistic=statistic,
+                        save_dir=save_dir,
+                    ),
+                )
             )
 
             # For each sector within specified dictionary...
@@ -382,16 +447,24 @@ def main():
             ) in cfg.SECTOR_DICTIONARIES.items():
                 # Create stacked barplot of emissions by country stacked by
                 # sector.
-                create_emissions_by_sector(
-                    emissions_df=emissions_df,
-                    emissions_col=emissions_col,
-                    sector=sector,
-                    sector_codes=list(sector_codes_palettes.keys()),
-                    palette=sector_codes_palettes,
-                    statistic=statistic,
-                    save_dir=save_dir,
+                plot_tasks.append(
+                    (
+                        create_emissions_by_sector,
+                        dict(
+                            sector_overall_emissions=sector_emissions[sector],
+                            emissions_col=emissions_col,
+                            sector=sector,
+                            palette=sector_codes_palettes,
+                            statistic=statistic,
+                            save_dir=save_dir,
+                        ),
+                    )
                 )
 
+    # Create the plots in parallel, each is independent of the others.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_run_plot_task, plot_tasks))
+
 
 if __name__ == "__main__":
     main()